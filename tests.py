@@ -47,6 +47,27 @@ class TestWeightedDict(unittest.TestCase):
 
         print(wdict)
 
+    # Batch sampling should match the per-call distribution.
+    def test_sample_n(self):
+        random.seed(42)
+
+        wdict = WeightedDict()
+        data = {'a': 5., 'b': 1., 'c': 14., 'd': 0.}
+
+        for i, j in data.items():
+            wdict[i] = j
+
+        num_samples = 20000
+        tallies = Counter(wdict.sample_n(num_samples))
+        den = sum(data.values())
+
+        self.assertEqual(sum(tallies.values()), num_samples)
+        self.assertEqual(tallies['d'], 0)
+
+        for i, j in data.items():
+            self.assertLess(abs(tallies[i] - num_samples * j / den),
+                            num_samples * .02)
+
     # A more rigorous test
     def test_big(self):
         random.seed(42)
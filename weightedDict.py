@@ -20,6 +20,7 @@
 # The following operations are all O(log n) time, worst case:
 #
 # wdict.sample()        # random sample
+# wdict.sample_n(k)     # batch of k random samples (amortized O(1) each)
 # wdict[key] = value    # insertion (or value update)
 # wdict.remove(key)     # deletion
 # val = wdict[key]      # key-value lookup
@@ -34,16 +35,31 @@ from __future__ import division
 from __future__ import print_function
 
 import random
-from itertools import chain
+from collections import deque
+
+# numpy is optional; it only speeds up rebuilding the alias table.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Discarded nodes kept for reuse per dict, to bound pool memory.
+MAX_POOL_SIZE = 1024
 
 
 # A red-black tree with summaries at each node.
 # Only the leaves contain values for keys.
 class WeightedDict:
+    # Slotted: the tree allocates one instance per node, so skipping the
+    # per-instance __dict__ shrinks nodes ~3x and speeds attribute access.
+    __slots__ = ('length', 'min_key', 'val', 'lt', 'rt', 'up', 'black',
+                 '_keys', '_alias_prob', '_alias_idx', '_alias_dirty',
+                 '_stale_draws', '_key_to_leaf', '_pool')
+
     # key, val, sort by key
     # val is assumed to be <= 0.
     def __init__(self, min_key=None, val=0., parent=None):
-        self.length = 1 if parent else 0
+        self.length = 0  # Only maintained on the root.
         self.min_key = min_key
         self.val = val
         self.lt = None
@@ -51,22 +67,106 @@ class WeightedDict:
         self.up = parent
         self.black = False  # Whether the node is black.
 
-    # Adds a new element to the list.
+        # Alias table for O(1) sampling, built lazily on the root.
+        self._keys = None
+        self._alias_prob = None
+        self._alias_idx = None
+        self._alias_dirty = True
+        self._stale_draws = 0
+
+        # Companion hash map from key to its leaf, kept on the root.
+        # Makes membership and value lookup O(1); keys must be hashable.
+        self._key_to_leaf = {} if parent is None else None
+
+        # Free list of discarded nodes, kept on the root so insert/
+        # delete churn recycles nodes instead of reallocating them.
+        self._pool = [] if parent is None else None
+
+    # Adds a new element to the list, or updates an existing key's value.
     def __setitem__(self, key, val):
-        # If key is already in dict, remove it and add it with the new value.
-        if key in self:
-            self.update_val(key, float(val))
+        val = float(val)
+        leaf = self._key_to_leaf.get(key)
+
+        if leaf is None:
+            self.add_element(key, val)
         else:
-            self.add_element(key, float(val))
+            # Push the change up as a delta; no descent and no ancestor
+            # needs to re-read its other child.  Rewriting a key with
+            # its current value is a no-op — keep the alias table.
+            delta = val - leaf.val
+            if delta == 0.:
+                return
+
+            leaf.val = val
+            node = leaf.up
+
+            while node is not None:
+                node.val += delta
+                node = node.up
+
+        self._alias_dirty = True
+        self._stale_draws = 0
 
     # The whole purpose of this data structure!
-    def sample(self):
-        if not self.lt:
+    # Samples in O(1) from an alias table once sampling dominates; while
+    # the table is stale, isolated draws walk the tree in O(log n).
+    # (_rand is bound at definition time so each draw skips the
+    # random-module global lookups.)
+    def sample(self, _rand=random.random):
+        if self.lt is None:
             return self.min_key
-        if random.random() < self.lt.val / self.val:
-            return self.lt.sample()
-        else:
-            return self.rt.sample()
+
+        if self._alias_dirty:
+            self._stale_draws += 1
+            # Not worth an O(n) rebuild for a few draws between mutations.
+            if self._stale_draws < self.length:
+                return self._sample_u(_rand() * self.val)
+            self._build_alias()
+
+        i = int(_rand() * len(self._keys))
+        if _rand() < self._alias_prob[i]:
+            return self._keys[i]
+        return self._keys[self._alias_idx[i]]
+
+    # Draws k samples at once.  Amortizes the table lookup setup over
+    # the batch; with numpy the whole batch runs as array operations.
+    def sample_n(self, k):
+        if self.lt is None:
+            return [self.min_key] * k
+        if self._alias_dirty:
+            self._build_alias()
+
+        keys = self._keys
+        prob, alias = self._alias_prob, self._alias_idx
+        n = len(keys)
+
+        if numpy is not None:
+            i = (numpy.random.random(k) * n).astype(numpy.intp)
+            keep = numpy.random.random(k) < numpy.asarray(prob)[i]
+            i = numpy.where(keep, i, numpy.asarray(alias)[i])
+            return [keys[j] for j in i]
+
+        rand = random.random
+        out = []
+
+        for _ in range(k):
+            i = int(rand() * n)
+            out.append(keys[i] if rand() < prob[i] else keys[alias[i]])
+        return out
+
+    # Descends with a single pre-scaled uniform: no per-level RNG call
+    # and no per-level division, just one compare (and sometimes a
+    # subtract) per node.
+    def _sample_u(self, u):
+        node = self
+
+        while node.lt is not None:
+            if u < node.lt.val:
+                node = node.lt
+            else:
+                u -= node.lt.val
+                node = node.rt
+        return node.min_key
 
     # Returns the length of the array/WeightedDict.
     def __len__(self):
@@ -74,42 +174,43 @@ class WeightedDict:
 
     # Returns true iff the tree contains element.
     def __contains__(self, key):
-        # See if we're at the bottom.
-        if not self.lt:
-            return self.min_key == key
-        elif self.rt.min_key <= key:
-            return key in self.rt
-
-        return key in self.lt
+        return key in self._key_to_leaf
 
     # Returns val give key.  Assumes key in tree.
     def __getitem__(self, key):
-        if not self.lt:
-            return self.val  # See if we're at the bottom.
-
-        # Else, look to right, then left.
-        elif self.rt.min_key <= key:
-            return self.rt[key]
-
-        return self.lt[key]
+        return self._key_to_leaf[key].val
 
     def keys(self):
-        if not self.lt:
-            return [self.min_key] if self.min_key is not None else []
-        return self.lt.keys() + self.rt.keys()
+        out = []
+        stack = [self]
+
+        # Push right before left so leaves pop off in sorted order.
+        while stack:
+            node = stack.pop()
+            if node.lt is not None:
+                stack.append(node.rt)
+                stack.append(node.lt)
+            elif node.min_key is not None:
+                out.append(node.min_key)
+        return out
 
     # Iterates over the keys in the keys' sorted order.
     def __iter__(self):
-        if not self.lt:
-            if self.min_key is not None:
-                yield self.min_key
+        stack = [self]
 
-        else:
-            for n in chain(self.lt, self.rt):
-                yield n
+        # Push right before left so leaves pop off in sorted order.
+        while stack:
+            node = stack.pop()
+            if node.lt is not None:
+                stack.append(node.rt)
+                stack.append(node.lt)
+            elif node.min_key is not None:
+                yield node.min_key
 
     # Deletes an element by key.
     def remove(self, index):
+        self._alias_dirty = True
+        self._stale_draws = 0
         if self.del_element(index):
             self.min_key, self.val = None, 0.
 
@@ -120,112 +221,166 @@ class WeightedDict:
         return dval
 
     # "Private" methods
-    # Assumes key is already in the dict
-    def update_val(self, key, newval):
-        if not self.lt:
-            self.val = newval
-            if self.up:
-                self.up.set_vals()
-
-        elif self.rt.min_key <= key:
-            self.rt.update_val(key, newval)
-
+    # Appends each leaf's (key, val) to the given lists, in key order.
+    def _collect_leaves(self, keys, weights):
+        if self.lt is None:
+            if self.min_key is not None:
+                keys.append(self.min_key)
+                weights.append(self.val)
+        else:
+            self.lt._collect_leaves(keys, weights)
+            self.rt._collect_leaves(keys, weights)
+
+    # Rebuilds the alias table (Vose's method) from the current weights.
+    # O(n); amortized away over the samples drawn before the next mutation.
+    def _build_alias(self):
+        keys, weights = [], []
+        self._collect_leaves(keys, weights)
+
+        n = len(keys)
+        # Scale so the average bucket holds probability 1.  The scaling
+        # multiply and the small/large partition vectorize in numpy; the
+        # pairing loop below stays in Python either way.
+        if numpy is not None:
+            q = numpy.asarray(weights) * (n / self.val)
+            small = deque(numpy.nonzero(q < 1.)[0].tolist())
+            large = deque(numpy.nonzero(q >= 1.)[0].tolist())
+            scaled = q.tolist()
         else:
-            self.lt.update_val(key, newval)
+            scaled = [w * n / self.val for w in weights]
+            small = deque(i for i in range(n) if scaled[i] < 1.)
+            large = deque(i for i in range(n) if scaled[i] >= 1.)
+        prob = [1.] * n
+        alias = list(range(n))
+
+        while small and large:
+            s, l = small.popleft(), large.popleft()
+            prob[s], alias[s] = scaled[s], l
+            scaled[l] -= 1. - scaled[s]
+
+            if scaled[l] < 1.:
+                small.append(l)
+            else:
+                large.append(l)
 
-    # Fixes the val for all ancestors
-    def set_vals(self):
-        self.val = self.lt.val + self.rt.val
-        if self.up:
-            self.up.set_vals()
+        # Leftovers (only due to float round-off) get probability 1.
+        self._keys, self._alias_prob, self._alias_idx = keys, prob, alias
+        self._alias_dirty = False
+        self._stale_draws = 0
 
     def add_element(self, key, val):
         self.length += 1
 
         # Check to see if we're the top.
-
         if self.min_key is None:
             self.min_key, self.val = key, val
-        # See if we're at the bottom.
-        elif not self.lt:
-            self.split(key, val)
-        else:
-            self.val += val
+            self._key_to_leaf[key] = self
+            return
+
+        # Walk down to the leaf where the new key belongs.
+        node = self
+
+        while node.lt is not None:
+            node.val += val
             # Look to the right.
-            if self.rt.min_key <= key:
-                self.rt.add_element(key, val)
+            if node.rt.min_key <= key:
+                node = node.rt
             # Look to the left.
             else:
-                if self.min_key > key:
-                    self.min_key = key
-                self.lt.add_element(key, val)
+                if node.min_key > key:
+                    node.min_key = key
+                node = node.lt
+
+        # The old leaf became internal; both its keys moved down a level.
+        node.split(key, val, self._pool)
+        self._key_to_leaf[node.lt.min_key] = node.lt
+        self._key_to_leaf[node.rt.min_key] = node.rt
 
     # Splits the WeightedDict into 2.
-    def split(self, key, val):
+    def split(self, key, val, pool):
         # Make right the larger of the 2.
-        (lkey, lval), (rkey, rval) = sorted(
-            [(self.min_key, self.val), (key, val)])
+        if key < self.min_key:
+            lkey, lval, rkey, rval = key, val, self.min_key, self.val
+        else:
+            lkey, lval, rkey, rval = self.min_key, self.val, key, val
 
         self.val = lval + rval
         self.min_key = lkey
 
-        self.lt = WeightedDict(lkey, lval, self)
-        self.rt = WeightedDict(rkey, rval, self)
+        self.lt = self._make_child(lkey, lval, pool)
+        self.rt = self._make_child(rkey, rval, pool)
 
         # Balancing the lt also takes care of the right.
         self.lt.rb_balance()
 
+    # Makes a leaf below this node, recycling a pooled node if any.
+    def _make_child(self, key, val, pool):
+        if pool:
+            node = pool.pop()
+            node.min_key, node.val, node.up = key, val, self
+            node.lt = node.rt = None
+            node.black = False
+            return node
+        return WeightedDict(key, val, self)
+
     # This does the balancing for when a node is added
     def rb_balance(self):
-        # If we're the top do nothing or the parent is black, do nothing.
-        if not self.up or self.up.black:
-            pass
-
-        # If we're 1 below the top.
-        elif not self.up.up:
-            self.up.black = True
-
-        # If our uncle's red then push the black grandparent down and recurse.
-        elif not self.up.brother().black:
-            self.up.up.black = False
-            self.up.black = True
-            self.up.brother().black = True
-            self.up.up.rb_balance()
-
-        elif not self.brother().black:  # If uncle's black & brother's red.
-            grandpa = self.up.up
-            self.up.black = True
-
-            if grandpa.lt == self.up:  # If our parent is on the left side
-                self.up.lt.black = True
-                self.up.up.rshift()
-            else:  # If our parent is on the right side
-                self.up.rt.black = True
-                self.up.up.lshift()
-
-            grandpa.black = False
-            grandpa.rb_balance()
-
-        else:  # If uncle's black & brother's black.
-            # If we're left and our parent's left.
-            if self.up.lt == self and self.up.up.lt == self.up:
-                self.up.up.rshift()
-
-            # If we're right and our parent's right.
-            elif self.up.rt == self and self.up.up.rt == self.up:
-                self.up.up.lshift()
-
-            elif self.up.rt == self:  # If we're right.
-                self.up.lshift()
-                self.up.up.rshift()
-
-            else:  # If we're left.
-                self.up.rshift()
-                self.up.up.lshift()
-
-    # Returns the brother of this node.
-    def brother(self):
-        return self.up.rt if self.up.lt == self else self.up.lt
+        node = self
+
+        while True:
+            # If we're the top do nothing or the parent is black, do nothing.
+            up = node.up
+            if up is None or up.black:
+                return
+
+            # If we're 1 below the top.
+            grandpa = up.up
+            if grandpa is None:
+                up.black = True
+                return
+
+            # If our uncle's red then push the black grandparent down and
+            # move up to it.
+            uncle = grandpa.rt if grandpa.lt is up else grandpa.lt
+            if not uncle.black:
+                grandpa.black = False
+                up.black = True
+                uncle.black = True
+                node = grandpa
+                continue
+
+            brother = up.rt if up.lt is node else up.lt
+            if not brother.black:  # If uncle's black & brother's red.
+                up.black = True
+
+                if grandpa.lt is up:  # If our parent is on the left side
+                    up.lt.black = True
+                    grandpa.rshift()
+                else:  # If our parent is on the right side
+                    up.rt.black = True
+                    grandpa.lshift()
+
+                grandpa.black = False
+                node = grandpa
+
+            else:  # If uncle's black & brother's black.
+                # If we're left and our parent's left.
+                if up.lt is node and grandpa.lt is up:
+                    grandpa.rshift()
+
+                # If we're right and our parent's right.
+                elif up.rt is node and grandpa.rt is up:
+                    grandpa.lshift()
+
+                elif up.rt is node:  # If we're right.
+                    up.lshift()
+                    grandpa.rshift()
+
+                else:  # If we're left.
+                    up.rshift()
+                    grandpa.lshift()
+
+                return
 
     # Perform these operations:
     #         rshift                        lshift
@@ -235,49 +390,58 @@ class WeightedDict:
     #   / \     -->     / \          / \     <--     / \
     #  A   B    -->    B   C        A   B    <--    B   C
     def rshift(self):
-        a = self.lt.lt
-        b = self.lt.rt
-        c = self.rt
         x = self.lt
+        a, b, c = x.lt, x.rt, self.rt
 
         self.lt, self.rt = a, x
-
-        x.length = len(b) + len(c)
+        x.lt, x.rt = b, c
         x.val = b.val + c.val
         x.min_key = b.min_key
-        x.lt, x.rt = b, c
         a.up, c.up = self, x  # Establish heredity
 
     def lshift(self):
-        b = self.rt.lt
-        c = self.rt.rt
         x = self.rt
-        a = self.lt
+        a, b, c = self.lt, x.lt, x.rt
 
         self.lt, self.rt = x, c
-
-        x.length = len(a) + len(b)
+        x.lt, x.rt = a, b
         x.val = a.val + b.val
         x.min_key = a.min_key
-        x.lt, x.rt = a, b
         c.up, a.up = self, x  # Establish heredity
 
     def del_element(self, key):
         self.length -= 1
+        del self._key_to_leaf[key]
 
         # See if we're at the bottom.
-        if not self.lt:
+        if self.lt is None:
             return True
 
-        if self.rt.min_key <= key:  # Look to the right.
-            if self.rt.del_element(key):
-                self.unsplit(self.lt)
-
-        # Look to the left.
-        elif self.lt.del_element(key):
-            self.unsplit(self.rt)
-
-        return False
+        # Walk down to the doomed leaf's parent.
+        node = self
+
+        while True:
+            # Look to the right, then to the left.
+            child = node.rt if node.rt.min_key <= key else node.lt
+
+            if child.lt is None:
+                w = node.lt if child is node.rt else node.rt
+                node.unsplit(w, child.val)
+                # If the survivor was a leaf, its key now lives in node.
+                if node.lt is None:
+                    self._key_to_leaf[node.min_key] = node
+
+                # Recycle the two detached nodes (the deleted leaf and
+                # the hoisted survivor's old shell).
+                pool = self._pool
+                if len(pool) < MAX_POOL_SIZE:
+                    child.up = None
+                    pool.append(child)
+                if len(pool) < MAX_POOL_SIZE:
+                    w.lt = w.rt = w.up = None
+                    pool.append(w)
+                return False
+            node = child
 
     # Hook the node to the W's l and r.
     #      T    -->    T            T      -->    T
@@ -285,28 +449,33 @@ class WeightedDict:
     #    W   X  -->  A   B   or   X   W    -->  A   B
     #   / \     -->                  / \   -->
     #  A   B    -->                 A   B  -->
-    def unsplit(self, w):
+    def unsplit(self, w, removed):
         self.lt, self.rt, self.min_key, self.val = w.lt, w.rt, w.min_key, w.val
 
         # Tell the trees of their new parent if they're not None.
-        if self.lt:
+        if self.lt is not None:
             self.lt.up, self.rt.up = self, self
-        if self.up:
-            self.up.set_mins()
-
-        self.rb_unsplit_fix(w.black)
 
-    # Propogates the changes to ancestors
-    def set_mins(self):
-        self.val = self.lt.val + self.rt.val
-        self.min_key = self.lt.min_key
+        # Every ancestor loses exactly the deleted leaf's weight, and
+        # min_key only changes along the leftmost-descendant path — so
+        # push the delta up rather than resumming children, and stop
+        # altogether once neither matters.  This runs before the
+        # rebalancing below, which expects consistent summaries.
+        node = self.up
+        update_min = node is not None and node.lt is self
+
+        while node is not None and (removed != 0. or update_min):
+            node.val -= removed
+            if update_min:
+                node.min_key = node.lt.min_key
+                update_min = node.up is None or node.up.lt is node
+            node = node.up
 
-        if self.up:
-            self.up.set_mins()
+        self.rb_unsplit_fix(w.black)
 
     # Tell the children that you're their parent, then fix the rb properties.
     def rb_unsplit_fix(self, nuked_black):
-        if not self.up:
+        if self.up is None:
             self.black = True  # See if we're at the top.
 
         elif not nuked_black:
@@ -320,91 +489,54 @@ class WeightedDict:
 
     # This is for when a node counts as 2 blacks(or black when it's red).
     def rb_solve_double_black(self):
-        # See if we're red.
-        if not self.black:
-            self.black = True
-
-        elif not self.up:
-            pass  # Do nothing if we're at the top..
-
-        elif not self.brother().black:  # See if our brother's red.
-            # Figure out to shift left or right.
-            if self.up.lt == self:
-                self.up.lshift()
-            else:
-                self.up.rshift()
-            self.rb_solve_double_black()
-
-        # See if our brother's children are both black.
-        elif self.brother().lt.black and self.brother().rt.black:
-            self.brother().black = False
-            self.up.rb_solve_double_black()
-
-        elif self.up.lt == self:  # See if we're on the left side.
-            if not self.up.rt.rt.black:  # See if our furthest nephew is red.
-                self.up.rt.rt.black = True
-                self.up.lshift()
-            else:  # Our nearest nephew must be red.
-                self.up.rt.rshift()
-                self.rb_solve_double_black()
-
-        else:  # OK, we're on the right side.
-            if not self.up.lt.lt.black:  # See if our furthest nephew is red.
-                self.up.lt.lt.black = True
-                self.up.rshift()
-            else:  # Our nearest nephew must be red.
-                self.up.lt.lshift()
-                self.rb_solve_double_black()
-
-    # For testing
+        node = self
+
+        while True:
+            # See if we're red.
+            if not node.black:
+                node.black = True
+                return
+
+            up = node.up
+            if up is None:
+                return  # Do nothing if we're at the top..
+
+            brother = up.rt if up.lt is node else up.lt
+            if not brother.black:  # See if our brother's red.
+                # Figure out to shift left or right.
+                if up.lt is node:
+                    up.lshift()
+                else:
+                    up.rshift()
+
+            # See if our brother's children are both black.
+            elif brother.lt.black and brother.rt.black:
+                brother.black = False
+                node = up
+
+            elif up.lt is node:  # See if we're on the left side.
+                if not brother.rt.black:  # Furthest nephew is red.
+                    brother.rt.black = True
+                    up.lshift()
+                    return
+                # Our nearest nephew must be red.
+                brother.rshift()
+
+            else:  # OK, we're on the right side.
+                if not brother.lt.black:  # Furthest nephew is red.
+                    brother.lt.black = True
+                    up.rshift()
+                    return
+                # Our nearest nephew must be red.
+                brother.lshift()
+
+    # For testing.  The renderer and the invariant checker are O(n) or
+    # worse per call, so they live in weightedDictDebug; these thin
+    # wrappers keep str(wdict) and wdict.check_tree() working.
     def __str__(self):
-        picture = [[' '] * (self.length * 4) for _ in range(self.depth() + 1)]
-        centre = self.get_str(picture, 0)
-        dstr = ' ' * centre + '|\n'
-
-        for i in reversed(picture):
-            dstr += ''.join(i).rstrip() + '\n'
-        return dstr
-
-    # Max nodes to bottom.
-    def depth(self):
-        return 0 if not self.lt else\
-            (1 + max(self.lt.depth(), self.rt.depth()))
-
-    # Returns the centre x-coordinate of this node.
-    def get_str(self, picture, offset):
-        depth = self.depth()
-
-        if depth == 0:
-            picture[0][4 * offset] = '*' if self.black else 'o'
-            return offset * 4
-
-        l_centre = self.lt.get_str(picture, offset)
-        r_centre = self.rt.get_str(picture, offset + len(self.lt))
-        my_centre = (l_centre + r_centre) // 2
-
-        for i in range(l_centre, r_centre, 1):
-            picture[depth][i] = '-'
-        for i in range(self.lt.depth() + 1, depth):
-            picture[i][l_centre] = '|'
-        for i in range(self.rt.depth() + 1, depth):
-            picture[i][r_centre] = '|'
-
-        picture[depth][my_centre] = '*' if self.black else 'o'
-        picture[depth][l_centre] = '/'
-        picture[depth][r_centre] = '\\'
-
-        return my_centre
+        from weightedDictDebug import tree_str
+        return tree_str(self)
 
     def check_tree(self):
-        if self.lt:
-            assert (self.lt.up == self)
-            assert (self.rt.up == self)
-            assert (self.min_key == self.lt.min_key)
-            assert (self.val == self.lt.val + self.rt.val)
-
-            # Both children of every red node should be black (or None)
-            assert (self.black or (self.lt.black and self.rt.black))
-
-            self.lt.check_tree()
-            self.rt.check_tree()
+        from weightedDictDebug import check_tree
+        check_tree(self)
@@ -0,0 +1,95 @@
+# Copyright 2018 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Debugging helpers for WeightedDict: the ASCII tree renderer and the
+# invariant checker.  Everything here is O(n) or worse per call and
+# allocates freely, so it lives outside the production module;
+# WeightedDict.__str__ and check_tree import it on first use.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+
+# Renders the tree, one node per leaf column, black nodes as '*' and
+# red nodes as 'o'.
+def tree_str(tree):
+    sizes = leaf_counts(tree, {})
+    picture = [[' '] * (sizes[id(tree)] * 4) for _ in range(depth(tree) + 1)]
+    centre = get_str(tree, picture, 0, sizes)
+    dstr = ' ' * centre + '|\n'
+
+    for i in reversed(picture):
+        dstr += ''.join(i).rstrip() + '\n'
+    return dstr
+
+
+# Max nodes to bottom.
+def depth(node):
+    return 0 if node.lt is None else\
+        (1 + max(depth(node.lt), depth(node.rt)))
+
+
+# Fills in the number of leaves under each node, keyed by node id.
+# (Per-node counts aren't maintained during mutation; only the root
+# tracks the length.)
+def leaf_counts(node, sizes):
+    if node.lt is None:
+        sizes[id(node)] = 1
+    else:
+        leaf_counts(node.lt, sizes)
+        leaf_counts(node.rt, sizes)
+        sizes[id(node)] = sizes[id(node.lt)] + sizes[id(node.rt)]
+    return sizes
+
+
+# Returns the centre x-coordinate of this node.
+def get_str(node, picture, offset, sizes):
+    ddepth = depth(node)
+
+    if ddepth == 0:
+        picture[0][4 * offset] = '*' if node.black else 'o'
+        return offset * 4
+
+    l_centre = get_str(node.lt, picture, offset, sizes)
+    r_centre = get_str(node.rt, picture, offset + sizes[id(node.lt)], sizes)
+    my_centre = (l_centre + r_centre) // 2
+
+    for i in range(l_centre, r_centre, 1):
+        picture[ddepth][i] = '-'
+    for i in range(depth(node.lt) + 1, ddepth):
+        picture[i][l_centre] = '|'
+    for i in range(depth(node.rt) + 1, ddepth):
+        picture[i][r_centre] = '|'
+
+    picture[ddepth][my_centre] = '*' if node.black else 'o'
+    picture[ddepth][l_centre] = '/'
+    picture[ddepth][r_centre] = '\\'
+
+    return my_centre
+
+
+def check_tree(node):
+    if node.lt is not None:
+        assert (node.lt.up == node)
+        assert (node.rt.up == node)
+        assert (node.min_key == node.lt.min_key)
+        assert (node.val == node.lt.val + node.rt.val)
+
+        # Both children of every red node should be black (or None)
+        assert (node.black or (node.lt.black and node.rt.black))
+
+        check_tree(node.lt)
+        check_tree(node.rt)